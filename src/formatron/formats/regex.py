@@ -3,9 +3,15 @@ This module contains the RegexExtractor class, which is used to extract data usi
 """
 import re
 import typing
+from functools import lru_cache
 from formatron.extractor import NonterminalExtractor
 
 
+@lru_cache(maxsize=1024)
+def _compile(regex: str) -> re.Pattern:
+    return re.compile(regex)
+
+
 class RegexExtractor(NonterminalExtractor):
     """
     An extractor that extracts a string using a regular expression.
@@ -21,7 +27,7 @@ class RegexExtractor(NonterminalExtractor):
             nonterminal: The nonterminal representing the extractor.
         """
         super().__init__(nonterminal, capture_name)
-        self._regex = re.compile(regex)
+        self._regex = _compile(regex)
 
     def extract(self, input_str: str) -> typing.Optional[tuple[str, re.Match | None]]:
         """
@@ -36,7 +42,7 @@ class RegexExtractor(NonterminalExtractor):
         matched = self._regex.match(input_str)
         if not matched:
             return None
-        return input_str[matched.span()[1]:], matched
+        return input_str[matched.end():], matched
 
     @property
     def kbnf_definition(self) -> str:
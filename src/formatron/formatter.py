@@ -3,24 +3,68 @@ This module contains the Formatter class and its related classes.
 """
 import abc
 import collections
+import itertools
 from json import JSONDecodeError
 import json
 import re
 import textwrap
+import threading
 import typing
 from copy import copy
+from functools import lru_cache
 import kbnf
 from formatron.formats.json import JsonExtractor
 from formatron.schemas.schema import Schema
 from formatron.extractor import Extractor, LiteralExtractor, NonterminalExtractor, ChoiceExtractor, SubstringExtractor
 from formatron.formats.regex import RegexExtractor
+try:
+    import torch
+    from formatron import kernels
+except ImportError:
+    torch = None
 
+_PLACEHOLDER_RE = re.compile(r"(?<!\\)\$\{([^$}]+)\}")
+_FINISHED = kbnf.AcceptTokenResult.Finished
+_ENGINE_CACHE_SIZE = 4
+
+
+@lru_cache(maxsize=4096)
+def _kbnf_literal_repr(literal: str) -> str:
+    return repr(literal)
+
+
+class _HashableConfig:
+    """
+    Wrap a KBNF engine configuration so that equal configurations hash to the same engine cache entry.
+    """
+    __slots__ = ("config", "_key")
+
+    def __init__(self, config: kbnf.Config | None):
+        self.config = config
+        self._key = None if config is None else self._fields(config)
+
+    @staticmethod
+    def _fields(obj) -> tuple:
+        fields = []
+        for name in dir(obj):
+            if name.startswith("_"):
+                continue
+            value = getattr(obj, name)
+            fields.append((name, _HashableConfig._fields(value) if name.endswith("_config") else repr(value)))
+        return tuple(fields)
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __eq__(self, other):
+        return isinstance(other, _HashableConfig) and self._key == other._key
 
 
 class FormatterBase(abc.ABC):
     """
     An abstract Formatter that enforces a format on the string generated by a language model. 
     """
+    __slots__ = ()
 
     @abc.abstractmethod
     def accept_token(self, token_id: int) -> typing.Any:
@@ -32,6 +76,19 @@ class FormatterBase(abc.ABC):
             The result of accepting the token.
         """
 
+    def accept_tokens(self, token_ids: typing.Sequence[int]) -> typing.Any:
+        """
+        Accept a sequence of tokens from the language model, one after another.
+        Args:
+            token_ids: The token IDs.
+        Returns:
+            The result of accepting the last token, or `None` if `token_ids` is empty.
+        """
+        result = None
+        for token_id in token_ids:
+            result = self.accept_token(token_id)
+        return result
+
     @abc.abstractmethod
     def accept_bytes(self, _bytes: bytes):
         """
@@ -46,6 +103,12 @@ class FormatterBase(abc.ABC):
         Compute the allowed tokens based on the current state.
         """
 
+    def prewarm(self) -> None:
+        """
+        Prepare the allowed tokens for the current state ahead of time, for example
+        while the language model is still processing the prompt. The default implementation does nothing.
+        """
+
     @abc.abstractmethod
     def mask_logits(self, logits) -> typing.Any:
         """
@@ -96,23 +159,38 @@ class Formatter(FormatterBase):
     multiple extractors in a sequential, unambiguous, greedy manner. Check out the Formatter.captures property docs for more details.
     If you need more complex extraction logic, you need to implement your own Extractor.
     """
+    __slots__ = ("_extractors", "_completion_extractors", "_records_tokens", "_engine", "_token_ids",
+                 "_decode_callback", "_grammar_str", "_captures", "_captures_view", "_allowed_tokens_computed",
+                 "_vocab_size", "_token_bitmask", "_token_bitmask_copied")
 
-    def __init__(self, extractors: list[Extractor], engine: kbnf.Engine,
+    def __init__(self, extractors: typing.Sequence[Extractor], engine: kbnf.Engine,
                  decode_callback: typing.Callable[[list[int]], str], grammar_str: str):
         """
         Initialize the formatter.
         Args:
-            extractors: The matchers to extract data from the generated string.
+            extractors: The matchers to extract data from the generated string. The formatter never mutates
+                this sequence, so builders may share one immutable sequence between formatters.
             engine: The KBNF engine to enforce the format.
             decode_callback: The callback to decode the token IDs to a string.
             grammar_str: The KBNF grammar string.
         """
         self._extractors = extractors
+        # Extractors after the last capturing one cannot affect the captures, so completion skips them.
+        # In particular, nothing is extracted on completion when no extractor captures.
+        end = max((i + 1 for i, extractor in enumerate(extractors) if extractor.capture_name), default=0)
+        self._completion_extractors = extractors[:end]
+        # The generated tokens are only needed to decode the output for the completion extractors.
+        self._records_tokens = end > 0
         self._engine = engine
         self._token_ids = []
         self._decode_callback = decode_callback
         self._grammar_str = grammar_str
-        self._captures = {}
+        self._captures = collections.defaultdict(list)
+        self._captures_view = None
+        self._allowed_tokens_computed = False
+        self._vocab_size = None
+        self._token_bitmask = None
+        self._token_bitmask_copied = None
 
     @property
     def grammar_str(self):
@@ -122,25 +200,130 @@ class Formatter(FormatterBase):
         return self._grammar_str
 
     def accept_token(self, token_id: int):
+        self._allowed_tokens_computed = False
         result = self._engine.try_accept_new_token(token_id)
-        self._token_ids.append(token_id)
-        if result == kbnf.AcceptTokenResult.Finished:
-            output = self._decode_callback(self._token_ids)
-            self._on_completion(output)
+        if self._records_tokens:
+            self._token_ids.append(token_id)
+            if result == _FINISHED:
+                output = self._decode_callback(self._token_ids)
+                self._on_completion(output)
+        return result
+
+    def accept_tokens(self, token_ids: typing.Sequence[int]):
+        self._allowed_tokens_computed = False
+        accept = self._engine.try_accept_new_token
+        result = None
+        if not self._records_tokens:
+            for token_id in token_ids:
+                result = accept(token_id)
+            return result
+        append = self._token_ids.append
+        for token_id in token_ids:
+            result = accept(token_id)
+            append(token_id)
+            if result == _FINISHED:
+                # Like accepting the tokens one by one, complete before any token after the end is rejected.
+                output = self._decode_callback(self._token_ids)
+                self._on_completion(output)
         return result
 
     def accept_bytes(self, _bytes: bytes):
+        self._allowed_tokens_computed = False
         self._engine.try_accept_new_bytes(_bytes)
 
     def compute_allowed_tokens(self) -> None:
+        """
+        Compute the allowed tokens based on the current state.
+        The computation is skipped if the state has not changed since the last computation.
+        """
+        if self._allowed_tokens_computed:
+            return
         self._engine.compute_allowed_token_ids()
+        self._allowed_tokens_computed = True
 
-    def mask_logits(self, logits) -> typing.Any:
-        return self._engine.mask_logits(logits)
+    def prewarm(self) -> None:
+        """
+        Compute the allowed tokens for the current state ahead of time, so that the next
+        `compute_allowed_tokens` call returns immediately.
+        The KBNF engine already computes and caches the allowed tokens of each state lazily.
+        """
+        self.compute_allowed_tokens()
+
+    def mask_logits(self, logits, *, out=None) -> typing.Any:
+        """
+        Mask the logits based on the current state.
+
+        For CUDA `torch.Tensor` logits, if Triton is installed, the engine writes the allowed tokens into a token
+        bitmask owned by the formatter, which a Triton kernel then applies on the device. The bitmask is allocated
+        once in pinned memory, so that it can be copied to the device asynchronously without a fresh allocation
+        per token. Other logits are masked by the engine, which caches the token indices of each state.
+        Args:
+            logits: The logits to mask.
+            out: The tensor or array to write the masked logits to. It may be `logits` itself.
+                If `None`, the masked logits may or may not be `logits` itself.
+        Returns:
+            The masked logits.
+        """
+        if torch is None or kernels.triton is None or not isinstance(logits, torch.Tensor) or not logits.is_cuda:
+            masked = self._engine.mask_logits(logits)
+            if out is None or out is masked:
+                return masked
+            out[...] = masked
+            return out
+        if out is None:
+            out = logits
+        elif out is not logits:
+            out.copy_(logits)
+        kernels.apply_token_bitmask_inplace(out, self._fill_token_bitmask(out.device))
+        return out
+
+    def _fill_token_bitmask(self, device) -> "torch.Tensor":
+        if self._token_bitmask is None:
+            self._token_bitmask = kernels.allocate_token_bitmask(self._get_vocab_size(), pin_memory=True)
+        elif self._token_bitmask_copied is not None:
+            # The previous asynchronous copy must finish reading the bitmask before it is overwritten.
+            self._token_bitmask_copied.synchronize()
+        self.get_allowed_token_mask(self._token_bitmask)
+        bitmask = self._token_bitmask.to(device, non_blocking=True)
+        # The copy is queued on the stream of the logits' device, which need not be the current device.
+        self._token_bitmask_copied = torch.cuda.Event()
+        self._token_bitmask_copied.record(torch.cuda.current_stream(device))
+        return bitmask
+
+    def _get_vocab_size(self) -> int:
+        if self._vocab_size is None:
+            self._vocab_size = self._engine.get_vocab().get_vocab_size()
+        return self._vocab_size
 
     def get_allowed_tokens_since_last_computation(self) -> typing.Sequence[int]:
         return self._engine.get_allowed_token_ids_from_last_computation()
 
+    def get_allowed_token_mask(self, out) -> None:
+        """
+        Write the allowed tokens since the last computation into a caller-owned token bitmask
+        without materializing a list of token IDs. Bit `i % 32` of the 32-bit word `i // 32`
+        is set if and only if token `i` is allowed.
+
+        Args:
+            out: A C-contiguous, writeable CPU `numpy.ndarray` or `torch.Tensor` of an integer dtype holding at least
+                `ceil(vocab_size / 32)` 32-bit words, for example a `numpy.uint64` array with `ceil(vocab_size / 64)` elements.
+        """
+        if torch is not None and isinstance(out, torch.Tensor):
+            assert out.device.type == "cpu" and out.is_contiguous(), \
+                f"The token bitmask must be a contiguous CPU tensor, while it is {out.device}"
+            assert not out.dtype.is_floating_point and not out.dtype.is_complex and out.dtype != torch.bool, \
+                f"The token bitmask must have an integer dtype, while it has {out.dtype}"
+            ptr, nbytes = out.data_ptr(), out.numel() * out.element_size()
+        else:
+            assert out.flags["C_CONTIGUOUS"], "The token bitmask must be a C-contiguous array"
+            assert out.flags["WRITEABLE"], "The token bitmask must be a writeable array"
+            assert out.dtype.kind in "iu", f"The token bitmask must have an integer dtype, while it has {out.dtype}"
+            ptr, nbytes = out.ctypes.data, out.nbytes
+        required = (self._get_vocab_size() + 31) // 32 * 4
+        assert nbytes >= required, f"The token bitmask has {nbytes} bytes, while {required} bytes are required"
+        assert ptr % 4 == 0, f"The token bitmask data pointer which points to {ptr} is not aligned to 4 bytes"
+        self._engine.fill_torch_bitmask(ptr)
+
     def is_completed(self) -> bool:
         """
         Check if the generation is completed. This means the generation is ended by the engine.
@@ -150,19 +333,17 @@ class Formatter(FormatterBase):
         return self._engine.is_finished()
 
     def _on_completion(self, generated_output: str) -> None:
-        for matcher in self._extractors:
+        captures = self._captures
+        for matcher in self._completion_extractors:
             result = matcher.extract(generated_output)
             if result is None:
                 captured = None
             else:
-                generated_output, captured = matcher.extract(generated_output)
-            if matcher.capture_name:
-                if matcher.capture_name in self._captures:
-                    self._captures[matcher.capture_name] = [
-                        self._captures[matcher.capture_name]]
-                    self._captures[matcher.capture_name].append(captured)
-                else:
-                    self._captures[matcher.capture_name] = captured
+                generated_output, captured = result
+            capture_name = matcher.capture_name
+            if capture_name:
+                captures[capture_name].append(captured)
+        self._captures_view = None
 
     @property
     def captures(self) -> dict[str, typing.Any] | None:
@@ -183,17 +364,44 @@ class Formatter(FormatterBase):
         ```
         The `b` extractor will always corresponding to `None` because the `a` extractor will always extract the whole string.
         This behavior is different from what a typical regular expression engine would do! 
+
+        If several extractors share a capture name, the capture is a list of their captures in order.
         """
-        return self._captures
+        if self._captures_view is None:
+            self._captures_view = {name: captured[0] if len(captured) == 1 else captured
+                                   for name, captured in self._captures.items()}
+        return self._captures_view
 
     def reset(self) -> None:
         self._captures.clear()
+        self._captures_view = None
         self._engine.reset()
         self._token_ids.clear()
+        self._allowed_tokens_computed = False
+
+    def __copy__(self):
+        """
+        Copy the formatter along with its engine state, so that the copy can accept tokens independently.
+        """
+        formatter = self.__class__.__new__(self.__class__)
+        for name in Formatter.__slots__:
+            setattr(formatter, name, getattr(self, name))
+        formatter._engine = copy(self._engine)
+        formatter._token_ids = list(self._token_ids)
+        formatter._captures = collections.defaultdict(list, {name: list(captured)
+                                                            for name, captured in self._captures.items()})
+        formatter._captures_view = None
+        # The flag tracks the engine it was set for, so the copied engine starts without computed allowed tokens.
+        formatter._allowed_tokens_computed = False
+        # The pinned bitmask is guarded by the event of its own in-flight copy, so each formatter needs its own.
+        formatter._vocab_size = None
+        formatter._token_bitmask = None
+        formatter._token_bitmask_copied = None
+        return formatter
 
     def __str__(self):
         return (f"Formatter(engine={self._engine}, "
-                f"captures={self._captures}, "
+                f"captures={self.captures}, "
                 f"extractors={len(self._extractors)}, "
                 f"completed={self.is_completed()}, "
                 f"token_ids={len(self._token_ids)})"
@@ -216,9 +424,32 @@ class FormatterBuilder:
         self._capture_names = set()
         self._nonterminal_to_extractor = {}
         self._extractors = []
+        self._grammar_str_cache = None
+        self._extractors_cache = None
+        self._shared = False
+        # Shared with forks, whose nonterminals created before forking have the same names
+        # and hence may build the same grammar strings.
+        self._engine_cache = {}
+        self._engine_cache_lock = threading.Lock()
+        self._renew_instance_id = False
+        self._assign_instance_id()
+
+    def _assign_instance_id(self) -> None:
         self._instance_id = self.__class__._formatter_builder_counter
+        self._instance_suffix = f"_{self._instance_id}"
         self.__class__._formatter_builder_counter += 1
 
+    def clear_engine_cache(self) -> None:
+        """
+        Clear the compiled KBNF engines cached by this builder and its forks.
+
+        Each cached engine keeps its compiled grammar, a reference to its vocabulary and the allowed tokens
+        it has computed so far, which can take over ten megabytes for a 50k-token vocabulary.
+        The cache holds at most a few engines and is released along with the builder and its forks.
+        Formatters that are already built are not affected. This method is thread-safe.
+        """
+        with self._engine_cache_lock:
+            self._engine_cache.clear()
 
     def _assert_capture_name_valid(self, capture_name: str):
         assert capture_name.isidentifier(), (f"capture_name {capture_name}"
@@ -255,43 +486,59 @@ class FormatterBuilder:
 
         Note that if you need a literal `$`, you need to escape it by adding a backslash: `\\$`.
         """
-        state = "normal"
+        self._before_mutation()
+        main_rule = []
+        extractors = []
         last = 0
-
-        def append_literal(end):
-            if last < end:
-                literal = string[last:end]
-                self._main_rule.append(repr(literal))
-                self._extractors.append(LiteralExtractor(literal))
-
-        for i, char in enumerate(string):
-            if char == "$":
-                if state != "escaped":
-                    state = "dollar"
-                else:
-                    state = "normal"
-            elif state == "dollar":
-                if char == "{":
-                    append_literal(i - 1)
-                    last = i + 1
-                    state = "left_bracket"
-                else:
-                    state = "normal"
-            elif state == "left_bracket":
-                if char == "}":
-                    state = "normal"
-                    self._main_rule.append(string[last:i])
-                    self._extractors.append(
-                        self._nonterminal_to_extractor[string[last:i]])
-                    last = i + 1
-            elif char == "\\":
-                state = "escaped"
-            else:
-                state = "normal"
-        append_literal(len(string))
+        for placeholder in _PLACEHOLDER_RE.finditer(string):
+            start = placeholder.start()
+            if last < start:
+                literal = string[last:start]
+                main_rule.append(_kbnf_literal_repr(literal))
+                extractors.append(LiteralExtractor(literal))
+            nonterminal = placeholder.group(1)
+            main_rule.append(nonterminal)
+            extractors.append(self._nonterminal_to_extractor[nonterminal])
+            last = placeholder.end()
+        if last < len(string):
+            literal = string[last:]
+            main_rule.append(_kbnf_literal_repr(literal))
+            extractors.append(LiteralExtractor(literal))
+        self._main_rule.extend(main_rule)
+        self._extractors.extend(extractors)
+
+    def fork(self) -> "FormatterBuilder":
+        """
+        Create a builder with the same format as this one, to be extended independently.
+
+        Forking is cheap: both builders share their state until either of them is modified,
+        at which point the modified builder copies it. The nonterminals created afterwards get names unique to
+        each builder, so an extractor created by one fork cannot be used in another. Forks that only append
+        strings to identical formats still share the cached compiled engine.
+        Returns:
+            The forked builder.
+        """
+        forked = copy(self)
+        self._shared = forked._shared = True
+        self._renew_instance_id = forked._renew_instance_id = True
+        return forked
+
+    def _before_mutation(self) -> None:
+        if self._shared:
+            self._main_rule = list(self._main_rule)
+            self._rules = list(self._rules)
+            self._capture_names = set(self._capture_names)
+            self._nonterminal_to_extractor = dict(self._nonterminal_to_extractor)
+            self._extractors = list(self._extractors)
+            self._shared = False
+        self._grammar_str_cache = None
+        self._extractors_cache = None
 
     def _create_nonterminal(self, name: str) -> str:
-        nonterminal = f"__{name}_{self._counter}_{self._instance_id}"
+        if self._renew_instance_id:
+            self._assign_instance_id()
+            self._renew_instance_id = False
+        nonterminal = "".join(("__", name, "_", str(self._counter), self._instance_suffix))
         self._counter += 1
         return nonterminal
 
@@ -322,6 +569,7 @@ class FormatterBuilder:
                                    lambda nonterminal: ChoiceExtractor(new_extractors, capture_name, nonterminal))
 
     def _add_extractor(self, extractor_type: str, create_extractor: typing.Callable[[str], Extractor]):
+        self._before_mutation()
         nonterminal = self._create_nonterminal(extractor_type)
         extractor = create_extractor(nonterminal)
         if isinstance(extractor, NonterminalExtractor):
@@ -393,6 +641,7 @@ class FormatterBuilder:
         Returns:
             The string extractor.
         """
+        self._before_mutation()
         stop = [stop] if isinstance(stop, str) else stop or []
         nonterminal = self._create_nonterminal("str")
         if not stop:
@@ -400,13 +649,16 @@ class FormatterBuilder:
             nonterminal_regex = "#'.*'"
         else:
             backslash = '\\'
-            capture_regex = f".*?(?:{'|'.join([i.replace(backslash, backslash * 2) for i in map(re.escape, stop)])})"
-            nonterminal_regex = f"#e'{capture_regex}'"
+            # dict.fromkeys drops duplicated stop strings while keeping their order.
+            capture_regex = f".*?(?:{'|'.join(dict.fromkeys(map(re.escape, stop)))})"
+            nonterminal_regex = f"#e'{capture_regex.replace(backslash, backslash * 2)}'"
+        extractor = RegexExtractor(capture_regex, capture_name, nonterminal)
+        self._add_capture_name(extractor)
+        nonterminal = extractor.nonterminal
         self._rules.append(f"{nonterminal} ::= {nonterminal_regex};")
-        self._nonterminal_to_extractor[nonterminal] = RegexExtractor(
-            capture_regex, capture_name, nonterminal)
-        return self._nonterminal_to_extractor[nonterminal]
-    
+        self._nonterminal_to_extractor[nonterminal] = extractor
+        return extractor
+
     def substr(self, string: str, *, capture_name: str = None, extract_empty_substring: bool = False) -> Extractor:
         """
         Create a substring extractor.
@@ -430,6 +682,13 @@ class FormatterBuilder:
         """
         Build a formatter from the builder. The builder will not be consumed and can be used again.
 
+        Compiled engines are cached by the builder and its forks, keyed by grammar string, vocabulary identity and
+        engine configuration, so building the same format with the same vocabulary again only copies the cached engine.
+        Each formatter still gets its own engine state. See `clear_engine_cache` for the memory cost.
+
+        A builder and its forks may build concurrently from several threads, since the engine cache is guarded
+        by a lock they share. They must not be modified while any of them is building, though.
+
         Args:
             vocabulary: The KBNF engine vocabulary for the formatter.
             decode: The callback to decode the token IDs to a string.
@@ -439,10 +698,22 @@ class FormatterBuilder:
         """
         assert len(
             self._main_rule) != 0, "An empty formatter builder cannot build!"
-        rules = copy(self._rules)
-        rules.append(f"start ::= {' '.join(self._main_rule)};")
-        grammar_str = "\n".join(rules)
-        engine = kbnf.Engine(grammar_str, vocabulary, engine_config)
-        extractors = copy(self._extractors)
-        f = Formatter(extractors, engine, decode, grammar_str)
+        if self._grammar_str_cache is None:
+            start_rule = f"start ::= {' '.join(self._main_rule)};"
+            self._grammar_str_cache = "\n".join(itertools.chain(self._rules, (start_rule,)))
+            self._extractors_cache = tuple(self._extractors)
+        grammar_str = self._grammar_str_cache
+        key = (grammar_str, vocabulary, _HashableConfig(engine_config))
+        with self._engine_cache_lock:
+            engine = self._engine_cache.get(key)
+        if engine is None:
+            # Compile outside the lock; a concurrent build of the same key at worst compiles it twice.
+            engine = kbnf.Engine(grammar_str, vocabulary, engine_config)
+            with self._engine_cache_lock:
+                if len(self._engine_cache) >= _ENGINE_CACHE_SIZE:
+                    # Evict the least recently compiled engine.
+                    del self._engine_cache[next(iter(self._engine_cache))]
+                self._engine_cache[key] = engine
+        engine = copy(engine)
+        f = Formatter(self._extractors_cache, engine, decode, grammar_str)
         return f
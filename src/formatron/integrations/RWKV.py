@@ -66,8 +66,7 @@ class PIPELINE(rwkv.utils.PIPELINE):  # NOSONAR
             tokens = self.encode(ctx) if i == 0 else [token]
             if self.formatter is not None:
                 if i == 0 and args.engine_gen_config.read_prompt:
-                    for token in tokens:
-                        self.formatter.accept_token(token)
+                    self.formatter.accept_tokens(tokens)
             while len(tokens) > 0:
                 out, state = self.model.forward(tokens[:args.chunk_len], state)
                 tokens = tokens[args.chunk_len:]
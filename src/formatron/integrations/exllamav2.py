@@ -66,7 +66,7 @@ class FormatterFilter(ExLlamaV2Filter):
         c.model = self.model
         c.tokenizer = self.tokenizer
         c.sequence_str = self.sequence_str
-        # formatter does not have mutable public state anyway
+        # copying a formatter also copies its engine state, so the clone advances independently
         c._formatter = copy(self._formatter)
         c._config = deepcopy(self._config)
         c._pass_tokens = self._pass_tokens
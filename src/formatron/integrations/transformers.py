@@ -97,8 +97,7 @@ class FormattersLogitsProcessor(LogitsProcessor):
                 if config.reset_at_beginning:
                     formatter.reset()
                 if config.read_prompt:
-                    for token in prompt:
-                        formatter.accept_token(token)
+                    formatter.accept_tokens(prompt)
         else:
             assert input_ids.shape[1] == self._last_input_id_length + 1, ("One iteration in generation loop"
                                                                           " must add exactly one token.")
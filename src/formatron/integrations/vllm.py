@@ -66,8 +66,7 @@ class FormattersLogitsProcessor:
             if config.reset_at_beginning and formatter.is_completed():
                 formatter.reset()
             if config.read_prompt:
-                for token in prompt:
-                    formatter.accept_token(token)
+                formatter.accept_tokens(prompt)
         elif len(generated_tokens) == self._last_input_id_length + 1:  # to next batch step
             assert result is None, (f"Batch size {self._debug_counter} "
                                     f"is less than number of formatters({len(self._formatters)})!")
@@ -0,0 +1,81 @@
+"""
+This module contains the tensor routines that apply token bitmasks filled by KBNF engines to logits.
+
+A token bitmask is an int32 tensor in which bit `i % 32` of element `i // 32` is set if and only if token `i` is allowed.
+On CUDA (or ROCm) devices, the bitmask is applied by a Triton kernel if Triton is installed.
+"""
+import torch
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+__all__ = ["allocate_token_bitmask", "apply_token_bitmask_inplace"]
+
+
+def allocate_token_bitmask(vocab_size: int, *, pin_memory: bool = False) -> torch.Tensor:
+    """
+    Allocate an uninitialized token bitmask on CPU.
+
+    Args:
+        vocab_size: The number of tokens the bitmask covers.
+        pin_memory: Whether to allocate the bitmask in pinned memory for asynchronous copies to CUDA devices.
+    Returns:
+        The token bitmask.
+    """
+    return torch.empty(((vocab_size + 31) // 32,), dtype=torch.int32, pin_memory=pin_memory)
+
+
+def apply_token_bitmask_inplace(logits: torch.Tensor, bitmask: torch.Tensor) -> None:
+    """
+    Set the logits of disallowed tokens to negative infinity in place.
+    Tokens beyond the range covered by the bitmask are disallowed.
+
+    Args:
+        logits: The logits of shape `(vocab_size,)` or `(1, vocab_size)`.
+        bitmask: The token bitmask, on the same device as the logits.
+    """
+    assert logits.dim() == 1 or logits.dim() == 2 and logits.shape[0] == 1, \
+        f"Only logits with shape (n) or (1,n) are supported, while the actual logits shape is {logits.shape}"
+    assert bitmask.device == logits.device, \
+        f"The bitmask is on {bitmask.device}, while the logits are on {logits.device}"
+    if triton is not None and logits.is_cuda and logits.is_contiguous():
+        _apply_token_bitmask_inplace_triton(logits, bitmask)
+        return
+    vocab_size = logits.shape[-1]
+    shifts = torch.arange(32, dtype=torch.int32, device=bitmask.device)
+    allowed = ((bitmask.unsqueeze(-1) >> shifts) & 1).view(-1).bool()
+    if allowed.shape[0] >= vocab_size:
+        allowed = allowed[:vocab_size]
+    else:
+        allowed = torch.nn.functional.pad(allowed, (0, vocab_size - allowed.shape[0]))
+    logits.masked_fill_(~allowed, float("-inf"))
+
+
+_BLOCK_SIZE = 128
+
+if triton is not None:
+    @triton.jit
+    def _apply_token_bitmask_inplace_kernel(logits_ptr, bitmask_ptr, vocab_size, bitmask_size,
+                                            BLOCK_SIZE: tl.constexpr):
+        # Each program handles BLOCK_SIZE tokens, that is BLOCK_SIZE // 32 bitmask words.
+        # Logits are only ever stored to, and only where the token is disallowed,
+        # so allowed tokens cost no global memory traffic on the logits.
+        block_offset = tl.program_id(0) * BLOCK_SIZE
+        offsets = block_offset + tl.arange(0, BLOCK_SIZE)
+        word_offsets = block_offset // 32 + tl.arange(0, BLOCK_SIZE // 32)
+        words = tl.load(bitmask_ptr + word_offsets, mask=word_offsets < bitmask_size, other=0)
+        disallowed = ((words[:, None] >> tl.arange(0, 32)[None, :]) & 1) == 0
+        disallowed = tl.reshape(disallowed, (BLOCK_SIZE,))
+        tl.store(logits_ptr + offsets, -float("inf"), mask=(offsets < vocab_size) & disallowed)
+
+
+def _apply_token_bitmask_inplace_triton(logits: torch.Tensor, bitmask: torch.Tensor) -> None:
+    vocab_size = logits.shape[-1]
+    grid = (triton.cdiv(vocab_size, _BLOCK_SIZE),)
+    # Triton launches on the current stream of the current device, which must be the logits' device
+    # for the launch to be ordered after the bitmask copy to that device.
+    with torch.cuda.device(logits.device):
+        _apply_token_bitmask_inplace_kernel[grid](logits, bitmask, vocab_size, bitmask.shape[0],
+                                                  BLOCK_SIZE=_BLOCK_SIZE, num_warps=4)
@@ -6,6 +6,8 @@ import formatron.schemas.pydantic
 import formatron.integrations.RWKV
 from rwkv.model import RWKV
 import numpy as np
+import pytest
+import kbnf
 import formatron
 
 
@@ -173,4 +175,233 @@ def test_grammar_literal(snapshot):
     snapshot.assert_match(pipeline.formatter.grammar_str)
     snapshot.assert_match(
         pipeline.generate("This is a random json: ", token_count=256, args=formatron.integrations.RWKV.PIPELINE_ARGS(top_p=0.5)))
-    snapshot.assert_match(pipeline.formatter.captures)
\ No newline at end of file
+    snapshot.assert_match(pipeline.formatter.captures)
+
+
+def _byte_vocabulary():
+    return kbnf.Vocabulary({i: kbnf.Token(bytes([i])) for i in range(256)},
+                           {i: chr(i) for i in range(256)})
+
+
+def _decode_bytes(tokens):
+    return bytes(tokens).decode("UTF-8", errors="replace")
+
+
+def _count_engine_compilations(monkeypatch):
+    compilations = []
+    engine = kbnf.Engine
+
+    def compile_engine(*args):
+        compilations.append(args)
+        return engine(*args)
+    monkeypatch.setattr(kbnf, "Engine", compile_engine)
+    return compilations
+
+
+def test_engine_cache(monkeypatch):
+    compilations = _count_engine_compilations(monkeypatch)
+    f = FormatterBuilder()
+    f.append_line(f"{f.regex('[0-9]+', capture_name='number')}")
+    vocabulary = _byte_vocabulary()
+    a = f.build(vocabulary, _decode_bytes)
+    b = f.build(vocabulary, _decode_bytes)
+    assert len(compilations) == 1
+    a.accept_tokens(list(b"42\n"))
+    assert a.is_completed()
+    assert not b.is_completed()
+    assert a.captures['number'].group(0) == "42"
+    f.clear_engine_cache()
+    f.build(vocabulary, _decode_bytes)
+    assert len(compilations) == 2
+
+
+def test_concurrent_build():
+    from concurrent.futures import ThreadPoolExecutor
+    f = FormatterBuilder()
+    f.append_line(f"{f.regex('[0-9]+', capture_name='number')}")
+    vocabularies = [_byte_vocabulary() for _ in range(8)]
+    with ThreadPoolExecutor(4) as executor:
+        formatters = list(executor.map(lambda i: f.build(vocabularies[i % 8], _decode_bytes), range(64)))
+    for formatter in formatters:
+        formatter.accept_tokens(list(b"42\n"))
+        assert formatter.captures['number'].group(0) == "42"
+
+
+def test_placeholders():
+    f = FormatterBuilder()
+    digit = f.regex('[0-9]', capture_name='digit')
+    letter = f.regex('[a-z]', capture_name='letter')
+    f.append_str(f"$\\${{x}} {digit}{letter} ${{ ${{}}")
+    formatter = f.build(_byte_vocabulary(), _decode_bytes)
+    start_rule = formatter.grammar_str.splitlines()[-1]
+    assert start_rule == f"start ::= '$\\\\${{x}} ' {digit.nonterminal} {letter.nonterminal} ' ${{ ${{}}';"
+    formatter.accept_tokens(list(b"$\\${x} 7z ${ ${}"))
+    assert formatter.is_completed()
+    assert formatter.captures['digit'].group(0) == "7"
+    assert formatter.captures['letter'].group(0) == "z"
+
+
+def test_accept_tokens():
+    f = FormatterBuilder()
+    f.append_line(f"Number: {f.regex('[0-9]+', capture_name='number')}")
+    formatter = f.build(_byte_vocabulary(), _decode_bytes)
+    formatter.accept_tokens(list(b"Number: "))
+    assert not formatter.is_completed()
+    formatter.accept_tokens(list(b"123\n"))
+    assert formatter.is_completed()
+    assert formatter.captures['number'].group(0) == "123"
+
+
+def test_accept_tokens_after_completion():
+    f = FormatterBuilder()
+    f.append_line(f"Number: {f.regex('[0-9]+', capture_name='number')}")
+    formatter = f.build(_byte_vocabulary(), _decode_bytes)
+    with pytest.raises(ValueError):
+        formatter.accept_tokens(list(b"Number: 123\n!"))
+    assert formatter.captures['number'].group(0) == "123"
+
+
+def test_prewarm():
+    f = FormatterBuilder()
+    f.append_str(f"{f.choose('yes', 'no', capture_name='answer')}")
+    formatter = f.build(_byte_vocabulary(), _decode_bytes)
+    formatter.prewarm()
+    assert sorted(formatter.get_allowed_tokens_since_last_computation()) == [ord('n'), ord('y')]
+    formatter.accept_token(ord('y'))
+    formatter.compute_allowed_tokens()
+    assert list(formatter.get_allowed_tokens_since_last_computation()) == [ord('e')]
+
+
+def test_copy():
+    from copy import copy
+    f = FormatterBuilder()
+    f.append_str(f"{f.choose('yes', 'no', capture_name='answer')}")
+    a = f.build(_byte_vocabulary(), _decode_bytes)
+    a.compute_allowed_tokens()
+    b = copy(a)
+    b.accept_tokens(list(b"ye"))
+    b.compute_allowed_tokens()
+    assert list(b.get_allowed_tokens_since_last_computation()) == [ord('s')]
+    a.compute_allowed_tokens()
+    assert sorted(a.get_allowed_tokens_since_last_computation()) == [ord('n'), ord('y')]
+    a.accept_tokens(list(b"no"))
+    assert a.captures['answer'] == "no"
+    assert not b.is_completed()
+
+
+def test_mask_logits_out():
+    import torch
+    f = FormatterBuilder()
+    f.append_str(f"{f.choose('yes', 'no', capture_name='answer')}")
+    formatter = f.build(_byte_vocabulary(), _decode_bytes)
+    formatter.compute_allowed_tokens()
+    logits = torch.zeros(256)
+    out = torch.empty(256)
+    assert formatter.mask_logits(logits, out=out) is out
+    assert torch.isfinite(out).nonzero().flatten().tolist() == [ord('n'), ord('y')]
+    assert torch.isfinite(logits).all()
+
+
+def test_apply_token_bitmask_inplace():
+    import torch
+    from formatron import kernels
+    bitmask = kernels.allocate_token_bitmask(40)
+    bitmask.copy_(torch.tensor([1 << 3, 1 << 1], dtype=torch.int32))
+    logits = torch.zeros(1, 40)
+    kernels.apply_token_bitmask_inplace(logits, bitmask)
+    assert torch.isfinite(logits).nonzero()[:, 1].tolist() == [3, 33]
+    with pytest.raises(AssertionError):
+        kernels.apply_token_bitmask_inplace(torch.zeros(2, 40), bitmask)
+    with pytest.raises(AssertionError):
+        kernels.apply_token_bitmask_inplace(torch.zeros(40, device="meta"), bitmask)
+
+
+def test_repeated_capture():
+    f = FormatterBuilder()
+    digit = f.regex('[0-9]', capture_name='digit')
+    f.append_line(f"{digit},{digit},{digit}")
+    formatter = f.build(_byte_vocabulary(), _decode_bytes)
+    formatter.accept_tokens(list(b"1,2,3\n"))
+    assert [m.group(0) for m in formatter.captures['digit']] == ["1", "2", "3"]
+    formatter.reset()
+    assert formatter.captures == {}
+
+
+def test_str_capture():
+    f = FormatterBuilder()
+    f.append_str(f"Name: {f.str(stop=['.', '!', '.'], capture_name='name')}")
+    formatter = f.build(_byte_vocabulary(), _decode_bytes)
+    assert "#e'.*?(?:\\\\.|!)'" in formatter.grammar_str
+    formatter.accept_tokens(list(b"Name: Van."))
+    assert formatter.is_completed()
+    assert formatter.captures['name'].group(0) == "Van."
+
+
+def test_allowed_token_mask():
+    f = FormatterBuilder()
+    f.append_str(f"{f.choose('yes', 'no', capture_name='answer')}")
+    formatter = f.build(_byte_vocabulary(), _decode_bytes)
+    formatter.compute_allowed_tokens()
+    mask = np.zeros(256 // 64, dtype=np.uint64)
+    formatter.get_allowed_token_mask(mask)
+    allowed = np.unpackbits(mask.view(np.uint8), bitorder='little').nonzero()[0].tolist()
+    assert allowed == sorted(formatter.get_allowed_tokens_since_last_computation())
+    mask.flags.writeable = False
+    with pytest.raises(AssertionError):
+        formatter.get_allowed_token_mask(mask)
+    import torch
+    with pytest.raises(AssertionError):
+        formatter.get_allowed_token_mask(torch.zeros(256 // 32, dtype=torch.float32))
+
+
+def test_completion_skips_trailing_extractors():
+    f = FormatterBuilder()
+    f.append_line(f"{f.regex('[a-z]+', capture_name='word')} and {f.regex('[0-9]+')}")
+    formatter = f.build(_byte_vocabulary(), _decode_bytes)
+    formatter.accept_tokens(list(b"abc and 42\n"))
+    assert formatter.is_completed()
+    assert formatter.captures['word'].group(0) == "abc"
+
+
+def test_fork(monkeypatch):
+    compilations = _count_engine_compilations(monkeypatch)
+    f = FormatterBuilder()
+    f.append_str(f"Name: {f.regex('[a-z]+', capture_name='name')}")
+    a = f.fork()
+    b = f.fork()
+    a.append_line(".")
+    b.append_line(".")
+    f.append_line("!")
+    vocabulary = _byte_vocabulary()
+    formatter = a.build(vocabulary, _decode_bytes)
+    assert formatter.grammar_str == b.build(vocabulary, _decode_bytes).grammar_str
+    assert len(compilations) == 1
+    formatter.accept_tokens(list(b"Name: van.\n"))
+    assert formatter.captures['name'].group(0) == "van"
+    assert f.build(vocabulary, _decode_bytes).grammar_str.endswith("'!\\n';")
+    assert len(compilations) == 2
+
+
+def test_fork_extractors_are_not_shared():
+    f = FormatterBuilder()
+    f.append_str("x")
+    a = f.fork()
+    letters = a.regex('[a-z]+')
+    f.regex('[0-9]+')
+    with pytest.raises(KeyError):
+        f.append_str(f"{letters}")
+    a.append_line(f"{letters}")
+    formatter = a.build(_byte_vocabulary(), _decode_bytes)
+    formatter.accept_tokens(list(b"xyz\n"))
+    assert formatter.is_completed()
+
+
+def test_no_capture_skips_token_history():
+    f = FormatterBuilder()
+    f.append_line(f"Number: {f.regex('[0-9]+')}")
+    decoded = []
+    formatter = f.build(_byte_vocabulary(), lambda tokens: decoded.append(tokens) or _decode_bytes(tokens))
+    formatter.accept_tokens(list(b"Number: 7\n"))
+    assert formatter.is_completed()
+    assert formatter.captures == {}
+    assert decoded == []